@@ -1,16 +1,261 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+import unicodedata
+from collections import Counter
+from concurrent.futures import wait
+from functools import lru_cache
+
 from .llm import preprocess_query
-from .nuclia import nuclia_search, build_context, get_nuclia_resource, get_temporal_download_url, download_resource_file
-from .clients import client
-from .config import CLAUDE_MODEL, INSTRUCTIONS
+from .nuclia import EMPTY_MAP, NUCLIA_POOL, nuclia_search, build_context_and_sources, batch_get_resources, get_temporal_download_url_expiring
+from .clients import client, CLAUDE_SEMAPHORE
+from .config import CLAUDE_MODEL, INSTRUCTIONS, NUCLIA_API_BASE, KB
+from .cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+# URL base de un recurso de Nuclia (fallback cuando una fuente no tiene otra URL)
+_RESOURCE_URL_PREFIX = f"{NUCLIA_API_BASE}/kb/{KB}/resource/"
+
+# Dominios que identifican una URL interna de Nuclia
+_NUCLIA_DOMAINS = ("nuclia", "rag.progress.cloud")
+
+# ── Caché de respuestas completas (preproceso + búsqueda + Claude + fuentes)
+# Cada respuesta vence a los 30 min o antes, cuando deja de servir la primera URL
+# temporal de sus fuentes (ver _store_answer).
+ANSWER_CACHE = TTLCache(maxsize=512, ttl=1800)
+
+# Pipelines en curso por llave de caché: requests idénticos concurrentes comparten uno solo
+_INFLIGHT: dict = {}
+
+# ── Reranking léxico antes de armar el prompt
+# Menos párrafos (y más relevantes) = prompt más corto, más barato y con menos ruido.
+RERANK_TOP_K = 8
+RERANK_MIN_SCORE = 0.0  # Sin score de Nuclia, se descartan los párrafos con score léxico <= a este valor
+RERANK_LEXICAL_WEIGHT = 0.5  # Peso del BM25 frente al score de Nuclia (ambos normalizados a 0-1)
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_TOKEN_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset("""
+    a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales cuando
+    de del desde donde dos el ella ellas ellos en entre era es esa esas ese eso esos esta estan
+    estas este esto estos fue ha hay la las le les lo los mas me mi mis muy no nos o para pero
+    por que quien se segun ser si sin sobre su sus tambien te tiene tienen tu un una uno unos
+    y ya yo the of and to in is for on what how
+""".split())
+
+
+def _answer_cache_key(question: str, size: int, max_chunks: int, use_semantic: bool, min_score: float) -> str:
+    """Llave estable para una pregunta normalizada + parámetros + configuración del modelo."""
+    normalized = " ".join(question.lower().split())
+    payload = json.dumps([normalized, size, max_chunks, use_semantic, min_score, CLAUDE_MODEL, INSTRUCTIONS])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _is_cacheable(use_semantic: bool, min_score: float) -> bool:
+    """
+    Búsquedas solo keyword y sin score mínimo son casos de cola (pruebas, depuración):
+    casi nunca se repiten y solo desplazarían de la caché a las respuestas habituales.
+    """
+    return use_semantic or min_score != 0.0
+
+
+def _tokenize(text: str) -> list:
+    """Minúsculas, sin acentos, sin stopwords ni tokens de un carácter."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _TOKEN_RE.findall(text) if len(t) > 1 and t not in _STOPWORDS]
+
+
+def rerank_paragraphs(
+    question: str,
+    hits: list,
+    top_k: int = RERANK_TOP_K,
+    min_score: float = RERANK_MIN_SCORE
+) -> list:
+    """
+    Reordena párrafos de Nuclia combinando un BM25 simplificado contra la consulta
+    (sin llamadas a modelos) con el score de Nuclia, y se queda con los top_k mejores.
+    Un párrafo con score de Nuclia nunca se descarta solo por no compartir términos
+    con la consulta (p. ej. hits de la búsqueda semántica).
+    
+    Args:
+        question: Consulta enviada a Nuclia
+        hits: Párrafos de nuclia_search (paragraphs.results)
+        top_k: Máximo de párrafos a conservar
+        min_score: Los párrafos sin score de Nuclia se descartan si su score léxico
+            es menor o igual (con 0.0, los que no comparten ningún término)
+    
+    Returns:
+        Lista de párrafos ordenada por relevancia combinada (empates en orden de Nuclia)
+    """
+    query_terms = set(_tokenize(question))
+    docs = [Counter(_tokenize(hit.get("text") or "")) for hit in hits]
+    if not query_terms or not docs:
+        return hits[:top_k]
+    
+    # Frecuencia de documento de cada término, calculada sobre este mismo lote
+    n_docs = len(docs)
+    avg_len = sum(sum(d.values()) for d in docs) / n_docs or 1.0
+    idf = {}
+    for term in query_terms:
+        df = sum(1 for d in docs if term in d)
+        idf[term] = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    
+    scores = []
+    for doc in docs:
+        length_norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * sum(doc.values()) / avg_len)
+        scores.append(sum(
+            idf[t] * doc[t] * (_BM25_K1 + 1) / (doc[t] + length_norm)
+            for t in query_terms if t in doc
+        ))
+    
+    # Sin coincidencias léxicas (p. ej. hits solo semánticos): respetar el orden de Nuclia
+    max_lexical = max(scores)
+    if not max_lexical:
+        return hits[:top_k]
+    
+    nuclia_scores = [hit.get("score") for hit in hits]
+    max_nuclia = max((s for s in nuclia_scores if s), default=0.0)
+    
+    def combined(i: int) -> float:
+        nuclia = nuclia_scores[i] / max_nuclia if nuclia_scores[i] and max_nuclia > 0 else 0.0
+        lexical = scores[i] / max_lexical
+        return RERANK_LEXICAL_WEIGHT * lexical + (1 - RERANK_LEXICAL_WEIGHT) * nuclia
+    
+    kept = [i for i in range(n_docs) if nuclia_scores[i] is not None or scores[i] > min_score]
+    ranked = sorted(kept, key=combined, reverse=True)  # sorted es estable: empates en orden de Nuclia
+    return [hits[i] for i in ranked][:top_k]
+
+
+async def _retrieve_context(
+    question: str,
+    size: int,
+    max_chunks: int,
+    use_semantic: bool,
+    min_score: float
+) -> tuple:
+    """
+    Pasos 1-4 del pipeline: preproceso, búsqueda en Nuclia, reranking y contexto.
+    
+    Returns:
+        (search, context, sources): resultados completos de Nuclia, el contexto
+        listo para el prompt de Claude y las fuentes base (sin enriquecer)
+    """
+    # 1. Preprocesar la consulta
+    consulta = await preprocess_query(question)
+    
+    # 2. Búsqueda híbrida (keyword + semantic)
+    features = ["keyword"]
+    if use_semantic:
+        features.append("semantic")
+    
+    search = await asyncio.to_thread(
+        nuclia_search,
+        consulta, 
+        size=size,
+        features=features,
+        min_score=min_score
+    )
+    
+    # 3. Reranking (BM25 contra la consulta enviada + score de Nuclia): solo los párrafos
+    #    más relevantes llegan a Claude y a las fuentes.
+    #    Primero se aplica min_score, para que hits descartados no ocupen lugares del top_k.
+    paragraphs = search.get("paragraphs") or {}
+    qualifying_hits = [
+        hit for hit in paragraphs.get("results", [])
+        if hit.get("score") is None or hit["score"] >= min_score
+    ]
+    ranked_hits = rerank_paragraphs(
+        consulta,
+        qualifying_hits,
+        top_k=min(max_chunks, RERANK_TOP_K)
+    )
+    ranked_search = {**search, "paragraphs": {**paragraphs, "results": ranked_hits}}
+    
+    # 4. Construir contexto con metadata y fuentes base en una sola pasada
+    context, sources = build_context_and_sources(
+        ranked_search, 
+        max_chunks=max_chunks,
+        min_score=min_score,
+        include_metadata=True
+    )
+    
+    return search, context, sources
+
+
+def _answer_request(question: str, context: str) -> dict:
+    """Parámetros de la llamada a Claude que genera la respuesta final."""
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": 800,
+        "temperature": 0.2,
+        "system": INSTRUCTIONS,
+        "messages": [{"role": "user", "content": f"Pregunta: {question}\n\nContexto:\n{context}"}],
+    }
+
+
+def _forget_inflight(cache_key: str, task: asyncio.Future) -> None:
+    """
+    Quita un pipeline terminado de _INFLIGHT (si no fue reemplazado por uno más nuevo).
+    Si falló, recupera y registra la excepción: con asyncio.shield puede no quedar
+    nadie esperándola y asyncio avisaría "Task exception was never retrieved".
+    """
+    if _INFLIGHT.get(cache_key) is task:
+        del _INFLIGHT[cache_key]
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("Pipeline de ask_agent falló: %r", task.exception())
+
+
+def _store_answer(cache_key: str, result: dict, usable_until: float | None) -> None:
+    """
+    Guarda una respuesta en la caché; las vacías no, para que se reintenten.
+    
+    Args:
+        usable_until: Instante (time.monotonic) hasta el que sirven las URLs
+            temporales de las fuentes; la entrada no vive más allá de ese punto
+    """
+    if not result["answer"].strip():
+        return
+    ttl = ANSWER_CACHE.ttl
+    if usable_until is not None:
+        ttl = min(ttl, usable_until - time.monotonic())
+    if ttl > 0:
+        ANSWER_CACHE.set(cache_key, (time.monotonic(), result), ttl=ttl)
+
+
+def _load_answer(cache_key: str) -> dict | None:
+    """
+    Respuesta cacheada con el ttl de cada URL temporal descontado del tiempo
+    que lleva en caché, o None si no hay.
+    """
+    entry = ANSWER_CACHE.get(cache_key)
+    if entry is None:
+        return None
+    stored_at, result = entry
+    elapsed = int(time.monotonic() - stored_at)
+    sources = []
+    for source in result["sources"]:
+        file_info = source.get("file")
+        if file_info and file_info.get("ttl") is not None:
+            source = {**source, "file": {**file_info, "ttl": max(0, file_info["ttl"] - elapsed)}}
+        sources.append(source)
+    return {**result, "sources": sources}
+
 
 # ── Orquestación mejorada
-def ask_agent(
+async def ask_agent(
     question: str, 
     *, 
     size: int = 30, 
     max_chunks: int = 20,
     use_semantic: bool = True,
-    min_score: float = 0.0
+    min_score: float = 0.0,
+    use_cache: bool = True
 ) -> dict:
     """
     Orquesta el pipeline RAG completo con mejoras.
@@ -21,55 +266,148 @@ def ask_agent(
         max_chunks: Máximo de párrafos para el contexto
         use_semantic: Si usar búsqueda semántica (además de keyword)
         min_score: Score mínimo para incluir resultados
+        use_cache: Si False, ignora la respuesta cacheada y la reemplaza con una nueva
     
     Returns:
-        dict con 'answer', 'sources' y 'search_results'
+        dict con 'answer', 'sources' y, si no viene de caché, 'search_results'
     """
-    # 1. Preprocesar la consulta
-    consulta = preprocess_query(question)
-    
-    # 2. Búsqueda híbrida (keyword + semantic)
-    features = ["keyword"]
-    if use_semantic:
-        features.append("semantic")
+    cache_key = _answer_cache_key(question, size, max_chunks, use_semantic, min_score)
+    if use_cache and _is_cacheable(use_semantic, min_score):
+        cached = _load_answer(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Misma pregunta ya en proceso: esperar ese resultado en vez de repetir el pipeline
+        pending = _INFLIGHT.get(cache_key)
+        if pending is not None:
+            return dict(await asyncio.shield(pending))
     
-    search = nuclia_search(
-        consulta, 
-        size=size,
-        features=features,
-        min_score=min_score
+    task = asyncio.ensure_future(
+        _run_ask(question, cache_key, size, max_chunks, use_semantic, min_score)
     )
+    _INFLIGHT[cache_key] = task
+    task.add_done_callback(lambda t: _forget_inflight(cache_key, t))
     
-    # 3. Construir contexto con metadata
-    context = build_context(
-        search, 
-        max_chunks=max_chunks,
-        include_metadata=True,
-        score_threshold=min_score
+    # shield: si este cliente se desconecta, los demás que esperan el mismo resultado no se cancelan
+    return dict(await asyncio.shield(task))
+
+
+async def _run_ask(
+    question: str,
+    cache_key: str,
+    size: int,
+    max_chunks: int,
+    use_semantic: bool,
+    min_score: float
+) -> dict:
+    """Ejecuta el pipeline completo de ask_agent y guarda el resultado en caché."""
+    search, context, sources = await _retrieve_context(
+        question, size, max_chunks, use_semantic, min_score
     )
 
-    # 4. Generar respuesta con Claude
-    response = client.messages.create(
-        model=CLAUDE_MODEL,
-        max_tokens=800,
-        temperature=0.2,
-        system=INSTRUCTIONS,
-        messages=[{"role": "user", "content": f"Pregunta: {question}\n\nContexto:\n{context}"}],
+    # 5. Generar respuesta con Claude y, en paralelo, extraer las fuentes para el frontend
+    #    (el enriquecimiento de URLs no depende de la respuesta del LLM)
+    async def generate():
+        async with CLAUDE_SEMAPHORE:
+            return await client.messages.create(**_answer_request(question, context))
+    
+    sources_task = asyncio.to_thread(_enrich_sources, sources, search.get("resources") or {})
+    response, (sources_info, usable_until) = await asyncio.gather(generate(), sources_task)
+    
+    # Solo bloques de texto (ignora tool_use, thinking, etc.)
+    answer = "".join([p.text for p in (response.content or []) if getattr(p, "type", None) == "text"])
+    
+    # En caché solo lo que se sirve en un hit; search_results va únicamente en la respuesta fresca
+    result = {"answer": answer, "sources": sources_info}
+    if _is_cacheable(use_semantic, min_score):
+        _store_answer(cache_key, result, usable_until)
+    
+    return {**result, "search_results": search}  # Resultados completos para referencia
+
+
+# ── Orquestación en streaming (sources primero, luego tokens de Claude)
+async def stream_agent(
+    question: str, 
+    *, 
+    size: int = 30, 
+    max_chunks: int = 20,
+    use_semantic: bool = True,
+    min_score: float = 0.0,
+    use_cache: bool = True
+):
+    """
+    Versión en streaming de ask_agent. Produce eventos (nombre, datos):
+    - ("sources", [...]) en cuanto las fuentes están listas
+    - ("token", {"t": "..."}) por cada fragmento de texto de Claude
+    - ("done", {}) al terminar
+    
+    La respuesta completa se guarda en la misma caché que usa ask_agent.
+    """
+    cache_key = _answer_cache_key(question, size, max_chunks, use_semantic, min_score)
+    cacheable = _is_cacheable(use_semantic, min_score)
+    if use_cache and cacheable:
+        cached = _load_answer(cache_key)
+        if cached is not None:
+            yield "sources", cached["sources"]
+            yield "token", {"t": cached["answer"]}
+            yield "done", {}
+            return
+    
+    search, context, sources = await _retrieve_context(
+        question, size, max_chunks, use_semantic, min_score
     )
-    parts = response.content or []
-    answer = "".join(getattr(p, "text", "") for p in parts)
     
-    # 5. Extraer información de fuentes para el frontend
-    sources_info = extract_sources_info(search, max_chunks, min_score)
+    # Las fuentes se enriquecen en un hilo y salen en cuanto están listas, sin esperar
+    # un cupo de CLAUDE_SEMAPHORE; el semáforo solo cubre el stream de Claude.
+    sources_info, usable_until = await asyncio.to_thread(
+        _enrich_sources, sources, search.get("resources") or {}
+    )
+    yield "sources", sources_info
     
-    return {
-        "answer": answer,
-        "sources": sources_info,
-        "search_results": search  # Resultados completos para referencia
-    }
+    chunks = []
+    async with CLAUDE_SEMAPHORE, client.messages.stream(**_answer_request(question, context)) as stream:
+        async for text in stream.text_stream:
+            chunks.append(text)
+            yield "token", {"t": text}
+    
+    if cacheable:
+        _store_answer(cache_key, {"answer": "".join(chunks), "sources": sources_info}, usable_until)
+    yield "done", {}
+
+
+def _retrieval_from_search(search_json: dict) -> dict:
+    """Formato de /ask (nuclia_search): recursos y párrafos en el nivel superior."""
+    return search_json
+
+
+def _retrieval_from_nuclia_ask(search_json: dict) -> dict:
+    """Formato de /nuclia-ask (ASK de Nuclia): resultados dentro de raw_response."""
+    raw_response = search_json.get("raw_response") or {}
+    
+    # Formato 1: raw_response.retrieval_results
+    retrieval_results = raw_response.get("retrieval_results")
+    
+    # Formato 2: retrieval en raw_response (otro formato de ASK)
+    if not retrieval_results:
+        retrieval = raw_response.get("retrieval")
+        retrieval_results = retrieval.get("results") if isinstance(retrieval, dict) else None
+    
+    # Sin resultados anidados: usar el nivel superior
+    return retrieval_results or search_json
+
+
+_RETRIEVAL_PARSERS = {
+    "search": _retrieval_from_search,
+    "nuclia_ask": _retrieval_from_nuclia_ask,
+}
 
 
-def extract_sources_info(search_json: dict, max_chunks: int = 20, score_threshold: float = 0.0) -> list:
+def extract_sources_info(
+    search_json: dict,
+    max_chunks: int = 20,
+    score_threshold: float = 0.0,
+    source_format: str | None = None
+) -> list:
     """
     Extrae información estructurada de las fuentes para mostrar en el frontend.
     Automáticamente obtiene URLs temporales de descarga para archivos usando el SDK de Nuclia.
@@ -78,159 +416,170 @@ def extract_sources_info(search_json: dict, max_chunks: int = 20, score_threshol
     - Endpoint /ask (nuclia_search): retrieval_results en nivel superior
     - Endpoint /nuclia-ask (ASK de Nuclia): raw_response.retrieval_results
     
+    Args:
+        source_format: 'search' o 'nuclia_ask' si el llamador ya conoce el formato;
+                       si es None se detecta por las llaves de la respuesta
+    
     Returns:
         Lista de diccionarios con información de cada fuente
     """
     # Extraer recursos y párrafos según el formato
-    retrieval_results = None
+    if source_format is None:
+        source_format = "nuclia_ask" if "raw_response" in search_json else "search"
+    retrieval_results = _RETRIEVAL_PARSERS[source_format](search_json)
     
-    # Formato 1: raw_response (de /nuclia-ask)
-    raw_response = search_json.get("raw_response", {})
-    if raw_response:
-        retrieval_results = raw_response.get("retrieval_results", {})
+    # Obtener recursos con su información básica
+    resources = retrieval_results.get("resources") or {}
     
-    # Formato 2: retrieval en raw_response (otro formato de ASK)
-    if not retrieval_results and raw_response:
-        retrieval = raw_response.get("retrieval", {})
-        retrieval_results = retrieval.get("results", {}) if isinstance(retrieval, dict) else {}
+    # Párrafos -> fuentes base (misma pasada que arma el contexto) y luego URLs/descargas
+    _, sources = build_context_and_sources(
+        retrieval_results,
+        max_chunks=max_chunks,
+        min_score=score_threshold,
+        include_metadata=False
+    )
+    return enrich_sources(sources, resources)
+
+
+def enrich_sources(sources: list, resources: dict) -> list:
+    """
+    Completa las fuentes base de build_context_and_sources con URL y, para
+    archivos, la información de descarga (URL temporal obtenida con el SDK).
+    Modifica las fuentes en su lugar y las devuelve.
     
-    # Formato 3: nivel superior (de /ask con nuclia_search)
-    if not retrieval_results:
-        retrieval_results = search_json
+    Args:
+        sources: Fuentes base (una por párrafo)
+        resources: Mapa resource_id -> recurso de la respuesta de búsqueda
     
-    # Obtener recursos con su información básica
-    resources = retrieval_results.get("resources", {})
+    Returns:
+        Lista de diccionarios con información de cada fuente
+    """
+    return _enrich_sources(sources, resources)[0]
+
+
+def _enrich_sources(sources: list, resources: dict) -> tuple:
+    """
+    Implementación de enrich_sources.
     
-    # Obtener párrafos
-    para = (retrieval_results.get("paragraphs") or {}).get("results", [])
-    sources = []
+    Returns:
+        (sources, usable_until): usable_until es el instante (time.monotonic) en que
+        vence la primera URL temporal incluida, o None si no hay URLs que expiren
+    """
+    # Pasada 1: detectar qué archivos no traen sus datos en la búsqueda
+    file_resources = {}
+    missing_ids = []
     
-    # Cache para recursos ya obtenidos del SDK (evitar llamadas duplicadas)
-    resources_cache = {}
+    for source in sources:
+        resource_id = source["resource_id"]
+        icon = resources.get(resource_id, EMPTY_MAP).get("icon", "")
+        
+        # Detectar tipo de recurso por icon
+        is_file = bool(icon) and "application/" in icon and icon != "application/stf-link"
+        
+        # Para archivos: usar data.files de la búsqueda (show=values) y solo
+        # pedir al SDK los recursos que no lo traen
+        if is_file and resource_id and resource_id not in file_resources:
+            resource_details = resources.get(resource_id, EMPTY_MAP)
+            file_resources[resource_id] = resource_details
+            if _first_file(resource_details) is None:
+                missing_ids.append(resource_id)
     
-    for idx, hit in enumerate(para[:max_chunks]):
-        score = hit.get("score", 0.0)
-        if score < score_threshold:
-            continue
-            
-        text = (hit.get("text") or "").strip()
-        if not text:
+    if missing_ids:
+        log.debug("Obteniendo %d recursos con SDK", len(missing_ids))
+        file_resources.update(batch_get_resources(missing_ids))
+    
+    # Pasada 2: lanzar en paralelo las URLs temporales por (rid, file_id)
+    files_by_resource = {}
+    url_futures = {}
+    
+    for resource_id, resource_details in file_resources.items():
+        file_data = _first_file(resource_details)
+        if file_data is None:
             continue
         
-        resource_id = hit.get("rid", "")
-        field = hit.get("field", "")
+        file_id = file_data["file_id"]
+        files_by_resource[resource_id] = file_data
+        log.debug("Obteniendo URL temporal para %s", file_id)
+        url_futures[(resource_id, file_id)] = NUCLIA_POOL.submit(
+            get_temporal_download_url_expiring, resource_id, file_id, ttl=3600
+        )
+    
+    wait(url_futures.values())
+    
+    # Pasada 3: completar las fuentes con los resultados ya resueltos
+    usable_until = None
+    for source in sources:
+        resource_id = source["resource_id"]
         
         # Información básica del recurso desde retrieval_results
-        resource_info = resources.get(resource_id, {})
-        title = resource_info.get("title", "Documento sin título")
+        resource_info = resources.get(resource_id, EMPTY_MAP)
         icon = resource_info.get("icon", "")
         
         # Inicializar variables
         url = ""
         file_download_info = None
         
-        # 1. Detectar tipo de recurso por icon
-        is_file = icon and "application/" in icon and icon != "application/stf-link"
-        is_link = icon == "application/stf-link"
-        
-        # 2. Para archivos: SIEMPRE obtener del SDK (no confiar en retrieval_results)
-        if is_file and resource_id:
+        # 1. Archivos: usar los datos y la URL temporal obtenidos en paralelo
+        if resource_id in files_by_resource:
+            file_data = files_by_resource[resource_id]
+            file_id = file_data["file_id"]
             try:
-                # Usar cache para evitar múltiples llamadas al mismo recurso
-                if resource_id not in resources_cache:
-                    print(f"🔍 Obteniendo recurso {resource_id} con SDK...")
-                    resource_details = get_nuclia_resource(resource_id)
-                    resources_cache[resource_id] = resource_details
-                else:
-                    resource_details = resources_cache[resource_id]
+                temporal_url, url_usable_until = url_futures[(resource_id, file_id)].result()
+                ttl = None  # URL estándar (sin token temporal): no vence
+                if url_usable_until is not None:
+                    usable_until = min(usable_until or url_usable_until, url_usable_until)
+                    ttl = max(0, int(url_usable_until - time.monotonic()))
+                content_type = file_data["content_type"]
+                kind = _file_kind(content_type)
                 
-                # Buscar file fields en data.files del recurso completo
-                data = resource_details.get("data", {})
-                files = data.get("files", {})
+                file_download_info = {
+                    "download_url": temporal_url,
+                    "content_type": content_type,
+                    "size": file_data["size"],
+                    "filename": file_data["filename"] or source["title"],
+                    "file_id": file_id,
+                    "kind": kind,
+                    # Flags que usa el frontend (derivados de kind)
+                    "is_pdf": kind == "pdf",
+                    "is_excel": kind == "excel",
+                    "ttl": ttl  # Segundos que le quedan a la URL temporal
+                }
                 
-                # Procesar archivos disponibles
-                for file_id, file_info in files.items():
-                    file_value = file_info.get("value", {})
-                    file_data = file_value.get("file", {})
-                    
-                    content_type = file_data.get("content_type", "")
-                    file_size = file_data.get("size", 0)
-                    filename = file_data.get("filename", title)
-                    
-                    if content_type:  # Si hay información del archivo
-                        # Obtener URL temporal de descarga usando SDK
-                        print(f"📥 Obteniendo URL temporal para {file_id}...")
-                        temporal_url = get_temporal_download_url(resource_id, file_id, ttl=3600)
-                        
-                        file_download_info = {
-                            "download_url": temporal_url,
-                            "content_type": content_type,
-                            "size": file_size,
-                            "filename": filename,
-                            "file_id": file_id,
-                            "is_pdf": "pdf" in content_type.lower(),
-                            "is_excel": "sheet" in content_type.lower() or "excel" in content_type.lower(),
-                            "ttl": 3600  # 1 hora de validez
-                        }
-                        
-                        url = temporal_url
-                        break  # Usar el primer archivo encontrado
-                        
+                url = temporal_url
             except Exception as e:
-                print(f"⚠️ Error obteniendo archivo para recurso {resource_id}: {e}")
+                log.warning("Error obteniendo archivo para recurso %s: %s", resource_id, e)
                 # Continuar sin información de descarga
                 pass
         
-        # 3. Para links, intentar obtener la URL original
-        elif is_link:
+        # 2. Para links, intentar obtener la URL original
+        elif icon == "application/stf-link":
             # Intentar de origin
-            origin = resource_info.get("origin", {})
+            origin = resource_info.get("origin", EMPTY_MAP)
             if isinstance(origin, dict):
                 url = origin.get("url", "") or origin.get("path", "")
             
             # Si no, intentar de metadata
             if not url:
-                metadata = resource_info.get("metadata", {})
+                metadata = resource_info.get("metadata", EMPTY_MAP)
                 if isinstance(metadata, dict):
                     url = metadata.get("uri", "") or metadata.get("url", "")
         
-        # 4. Fallback: si no hay URL, usar referencia al recurso
+        # 3. Fallback: si no hay URL, usar referencia al recurso
         if not url and resource_id:
-            from .config import NUCLIA_API_BASE, KB
-            url = f"{NUCLIA_API_BASE}/kb/{KB}/resource/{resource_id}"
-
-        
-        # Número de página
-        position = hit.get("position", {})
-        page_num = position.get("page_number")
-        
-        # Determinar tipo de URL y de recurso
-        url_type = "none"
-        resource_type = icon if icon else "unknown"
+            url = _RESOURCE_URL_PREFIX + resource_id
         
-        if url:
-            if "http://" in url or "https://" in url:
-                if "nuclia" in url or "rag.progress.cloud" in url:
-                    url_type = "nuclia"  # URL interna de Nuclia
-                else:
-                    url_type = "external"  # URL externa/original
+        # Determinar tipo de URL
+        if url.startswith(("http://", "https://")):
+            if any(domain in url for domain in _NUCLIA_DOMAINS):
+                url_type = "nuclia"  # URL interna de Nuclia
             else:
-                url_type = "resource"  # ID de recurso
+                url_type = "external"  # URL externa/original
+        else:
+            url_type = "resource" if url else "none"  # ID de recurso / sin URL
         
-        # Construir objeto de fuente
-        source = {
-            "id": idx + 1,
-            "title": title,
-            "text": text,
-            "score": round(score, 3) if score else None,
-            "page": page_num,
-            "field": field,
-            "resource_id": resource_id,
-            "url": url,  # URL para abrir el documento
-            "url_type": url_type,  # Tipo de URL
-            "resource_type": resource_type,  # Tipo de recurso (MIME type o icon)
-            "has_url": bool(url),  # Flag para saber si hay URL disponible
-        }
+        source["url"] = url  # URL para abrir el documento
+        source["url_type"] = url_type  # Tipo de URL
+        source["has_url"] = bool(url)  # Flag para saber si hay URL disponible
         
         # Agregar información de descarga si está disponible (PDF, Excel, etc.)
         if file_download_info:
@@ -238,9 +587,41 @@ def extract_sources_info(search_json: dict, max_chunks: int = 20, score_threshol
             source["is_downloadable"] = True
         else:
             source["is_downloadable"] = False
+    
+    return sources, usable_until
 
+
+@lru_cache(maxsize=64)
+def _file_kind(content_type: str) -> str:
+    """Clasifica un archivo por su content type: 'pdf', 'excel' u 'other' (memoizado)."""
+    content_type = content_type.lower()
+    if "pdf" in content_type:
+        return "pdf"
+    if "sheet" in content_type or "excel" in content_type:
+        return "excel"
+    return "other"
+
+
+def _first_file(resource_details: dict) -> dict | None:
+    """
+    Devuelve la metadata del primer archivo con content_type en data.files de un recurso.
+    
+    Returns:
+        dict con file_id, content_type, size y filename, o None si no hay archivos
+    """
+    # Buscar file fields en data.files del recurso completo
+    files = resource_details.get("data", EMPTY_MAP).get("files", EMPTY_MAP)
+    
+    for file_id, file_info in files.items():
+        file_data = file_info.get("value", EMPTY_MAP).get("file", EMPTY_MAP)
+        content_type = file_data.get("content_type", "")
         
-        sources.append(source)
+        if content_type:  # Si hay información del archivo
+            return {
+                "file_id": file_id,
+                "content_type": content_type,
+                "size": file_data.get("size", 0),
+                "filename": file_data.get("filename"),
+            }
     
-    return sources
-
+    return None
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Hashable, Optional
+
+_MISSING = object()
+
+
+# ── Caché en memoria con expiración (TTL) y desalojo LRU
+class TTLCache:
+    """
+    Caché LRU en memoria con tiempo de vida por entrada. Es thread-safe, así que
+    puede compartirse entre los workers del pool de Nuclia y los requests de FastAPI.
+
+    Args:
+        maxsize: Número máximo de entradas antes de desalojar la menos usada
+        ttl: Tiempo de vida por defecto de cada entrada en segundos
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 1800):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def ttl_cached(cache: TTLCache, key: Optional[Callable[..., Hashable]] = None):
+    """
+    Decorador que memoiza una función en un TTLCache.
+    Las excepciones no se guardan: el siguiente llamado vuelve a intentar.
+
+    Args:
+        cache: Caché donde guardar los resultados
+        key: Función que construye la llave a partir de los argumentos
+             (por defecto, la tupla de argumentos posicionales)
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if key else args
+            value = cache.get(cache_key, _MISSING)
+            if value is _MISSING:
+                value = func(*args, **kwargs)
+                cache.set(cache_key, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
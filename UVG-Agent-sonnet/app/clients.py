@@ -1,5 +1,24 @@
-from anthropic import Anthropic
+import asyncio
+
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
 from .config import ANTHROPIC_KEY
 
-# ── Cliente Anthropic
-client = Anthropic(api_key=ANTHROPIC_KEY)
+# ── Cliente Anthropic (async, para no bloquear el event loop de FastAPI)
+# Con un pool de conexiones propio para reutilizar keep-alive entre requests
+client = AsyncAnthropic(
+    api_key=ANTHROPIC_KEY,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    ),
+)
+
+# Máximo de llamadas simultáneas a Claude por proceso (suaviza picos y rate limits)
+CLAUDE_SEMAPHORE = asyncio.Semaphore(16)
+
+# ── Cliente HTTP async compartido (proxy de descargas sin bloquear el event loop)
+ASYNC_HTTP = httpx.AsyncClient(
+    timeout=60,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=100),
+)
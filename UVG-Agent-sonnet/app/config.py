@@ -9,3 +9,6 @@ HEADERS = {"x-api-key": NUCLIA_TOKEN.strip()}
 ANTHROPIC_KEY = settings.ANTHROPIC_KEY
 CLAUDE_MODEL = settings.CLAUDE_MODEL
 INSTRUCTIONS = settings.INSTRUCTIONS
+
+DEBUG = settings.DEBUG
+LOG_LEVEL = settings.LOG_LEVEL
@@ -1,8 +1,12 @@
-from .clients import client
+import logging
+
+from .clients import client, CLAUDE_SEMAPHORE
 from .config import CLAUDE_MODEL
 
+log = logging.getLogger(__name__)
+
 # ── Preproceso de consulta (igual que tu versión)
-def preprocess_query(question: str) -> str:
+async def preprocess_query(question: str) -> str:
     """Usa un LLM para refinar la pregunta conversacional en una consulta de búsqueda."""
     system_prompt = (
         "Eres un optimizador de consultas experto. Tu única tarea es tomar una pregunta "
@@ -12,16 +16,17 @@ def preprocess_query(question: str) -> str:
         "Ejemplo: '¿Cómo puedo restaurar una copia de seguridad?' -> 'restaurar copia seguridad'"
     )
 
-    response = client.messages.create(
-        model=CLAUDE_MODEL,
-        max_tokens=100,   # Una consulta corta es suficiente
-        temperature=0.0,  # Queremos resultados consistentes, no creativos
-        system=system_prompt,
-        messages=[{"role": "user", "content": f"Pregunta original: {question}"}],
-    )
+    async with CLAUDE_SEMAPHORE:
+        response = await client.messages.create(
+            model=CLAUDE_MODEL,
+            max_tokens=100,   # Una consulta corta es suficiente
+            temperature=0.0,  # Queremos resultados consistentes, no creativos
+            system=system_prompt,
+            messages=[{"role": "user", "content": f"Pregunta original: {question}"}],
+        )
 
     new_query = "".join(getattr(p, "text", "") for p in response.content).strip()
-    print(new_query)
+    log.debug("Consulta preprocesada: %s", new_query)
 
     if not new_query:
         return question
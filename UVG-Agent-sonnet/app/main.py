@@ -1,16 +1,74 @@
 # app/main.py
-import requests
-from fastapi import FastAPI, HTTPException
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+from starlette.background import BackgroundTask
+
+from .schemas import (
+    AskBody,
+    NucliaAskBody,
+    ASK_BODY_ADAPTER,
+    NUCLIA_ASK_BODY_ADAPTER,
+    ask_body_schema,
+    nuclia_ask_body_schema,
+)
+from .agent import ask_agent, stream_agent
+from .nuclia import NUCLIA_HTTP, nuclia_ask, parse_nuclia_ask_response, download_resource_file
+from .clients import client, ASYNC_HTTP
+from .config import CLAUDE_MODEL, KB, DEBUG, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+
+# ── Warm-up: abrir DNS + TLS con Nuclia y Anthropic antes del primer request
+# Tope total del warm-up: NUCLIA_HTTP reintenta (con esperas) errores de conexión y
+# estados 429/5xx, así que el timeout por request no alcanza para acotar el arranque.
+_WARMUP_TIMEOUT = 5
+
+
+async def _warmup():
+    try:
+        results = await asyncio.wait_for(asyncio.gather(
+            asyncio.to_thread(NUCLIA_HTTP.get, f"/kb/{KB}", timeout=5),
+            # Llamada sin costo de tokens; timeout corto y sin reintentos para no retrasar el arranque
+            client.with_options(timeout=5, max_retries=0).models.list(limit=1),
+            return_exceptions=True,
+        ), _WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        # La llamada a Nuclia sigue en su hilo hasta terminar, pero ya no retrasa el arranque
+        log.warning("Warm-up no terminó en %ss; se continúa sin esperar", _WARMUP_TIMEOUT)
+        return
+    for name, result in zip(("Nuclia", "Anthropic"), results):
+        if isinstance(result, Exception):
+            log.warning("Warm-up de %s falló: %s", name, result)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await _warmup()
+    yield
+    # Cerrar los pools de conexiones al apagar
+    await client.close()
+    await ASYNC_HTTP.aclose()
+    NUCLIA_HTTP.close()
 
-from .schemas import AskBody, NucliaAskBody
-from .agent import ask_agent
-from .nuclia import nuclia_ask, parse_nuclia_ask_response, download_resource_file
-from .config import CLAUDE_MODEL, KB
 
 # ── API HTTP
-app = FastAPI(title="UVG Agent (Nuclia + Claude)")
+app = FastAPI(
+    title="UVG Agent (Nuclia + Claude)",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,19 +77,69 @@ app.add_middleware(
     allow_methods=["*"],
 )
 
+
+# ── Validación del body con los TypeAdapter del módulo de esquemas
+async def _parse_body(request: Request, adapter: TypeAdapter):
+    """
+    Lee el body crudo y lo valida con pydantic-core en una sola pasada (JSON → modelo).
+    Los errores se devuelven con el mismo formato 422 que usa FastAPI.
+    """
+    try:
+        return adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        )
+
+
+def _json_body(schema: dict) -> dict:
+    """openapi_extra para documentar un body que el handler valida manualmente."""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {k: v for k, v in schema.items() if k != "$defs"},
+                },
+            },
+        }
+    }
+
+
+def custom_openapi():
+    """Agrega a components los sub-esquemas ($defs) de los bodies documentados en openapi_extra."""
+    if app.openapi_schema:
+        return app.openapi_schema
+    schema = get_openapi(title=app.title, version=app.version, routes=app.routes)
+    components = schema.setdefault("components", {}).setdefault("schemas", {})
+    for body_schema in (ask_body_schema(), nuclia_ask_body_schema()):
+        components.update(body_schema.get("$defs", {}))
+    app.openapi_schema = schema
+    return schema
+
+
+app.openapi = custom_openapi
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
-@app.post("/ask")
-def ask(body: AskBody):
+@app.post("/ask", openapi_extra=_json_body(ask_body_schema()))
+async def ask(request: Request, no_cache: bool = False):
+    """
+    Pipeline RAG con Claude. Las respuestas se cachean por pregunta + parámetros;
+    `?no_cache=1` fuerza una respuesta nueva y refresca la caché.
+    """
+    body: AskBody = await _parse_body(request, ASK_BODY_ADAPTER)
     try:
-        result = ask_agent(
+        result = await ask_agent(
             body.query,
             size=body.size or 30,
             max_chunks=body.max_chunks or 20,
             use_semantic=body.use_semantic if body.use_semantic is not None else True,
             min_score=body.min_score or 0.0,
+            use_cache=not no_cache,
         )
         return {
             "answer": result["answer"],
@@ -45,7 +153,7 @@ def ask(body: AskBody):
                 "min_score": body.min_score or 0.0
             },
         }
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         status = e.response.status_code if e.response is not None else 502
         detail = e.response.text[:600] if e.response is not None else str(e)
         raise HTTPException(status_code=502, detail=f"Error consultando Nuclia ({status}): {detail}")
@@ -53,12 +161,49 @@ def ask(body: AskBody):
         raise HTTPException(status_code=502, detail=f"Error llamando a Claude: {e}")
 
 
-@app.post("/nuclia-ask")
-def nuclia_ask_endpoint(body: NucliaAskBody):
+@app.get("/ask/stream")
+async def ask_stream(
+    query: str = Query(..., min_length=2, max_length=2000),
+    size: int = Query(default=30, ge=1, le=100),
+    max_chunks: int = Query(default=20, ge=1, le=50),
+    use_semantic: bool = True,
+    min_score: float = Query(default=0.0, ge=0.0, le=1.0),
+    no_cache: bool = False,
+):
+    """
+    Igual que /ask pero en Server-Sent Events: primero un evento `sources`
+    (listo apenas responde Nuclia), luego eventos `token` con el texto de Claude
+    a medida que se genera, y al final `done` (o `error`).
+    """
+    async def event_stream():
+        try:
+            async for event, data in stream_agent(
+                query,
+                size=size,
+                max_chunks=max_chunks,
+                use_semantic=use_semantic,
+                min_score=min_score,
+                use_cache=not no_cache,
+            ):
+                yield f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+        except Exception as e:
+            error = orjson.dumps({"detail": f"Error procesando solicitud: {e}"}).decode()
+            yield f"event: error\ndata: {error}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/nuclia-ask", openapi_extra=_json_body(nuclia_ask_body_schema()))
+async def nuclia_ask_endpoint(request: Request):
     """
     Endpoint que usa directamente el /ask de Nuclia con su LLM generativo.
     Soporta contexto conversacional para chatbots y prompts personalizados.
     """
+    body: NucliaAskBody = await _parse_body(request, NUCLIA_ASK_BODY_ADAPTER)
     try:
         # Convertir contexto a formato esperado por Nuclia
         context = None
@@ -77,7 +222,8 @@ def nuclia_ask_endpoint(body: NucliaAskBody):
                 prompt["rephrase"] = body.prompt.rephrase
         
         # Llamar a Nuclia
-        raw_response = nuclia_ask(
+        raw_response = await asyncio.to_thread(
+            nuclia_ask,
             query=body.query,
             context=context,
             rephrase=body.rephrase or False,
@@ -92,7 +238,7 @@ def nuclia_ask_endpoint(body: NucliaAskBody):
         # Parsear respuesta
         parsed = parse_nuclia_ask_response(raw_response)
         
-        return {
+        result = {
             "answer": parsed["answer"],
             "sources": parsed["sources"],
             "metadata": parsed["metadata"],
@@ -105,10 +251,15 @@ def nuclia_ask_endpoint(body: NucliaAskBody):
                 "synchronous": body.synchronous if body.synchronous is not None else True,
                 "features": body.features
             },
-            "raw_response": raw_response  # Para debugging
         }
         
-    except requests.HTTPError as e:
+        # La respuesta cruda pesa cientos de KB: solo se devuelve en modo DEBUG
+        if DEBUG:
+            result["raw_response"] = raw_response
+        
+        return result
+        
+    except httpx.HTTPStatusError as e:
         status = e.response.status_code if e.response is not None else 502
         detail = e.response.text[:600] if e.response is not None else str(e)
         raise HTTPException(
@@ -120,10 +271,12 @@ def nuclia_ask_endpoint(body: NucliaAskBody):
 
 
 @app.get("/download/{resource_id}/{file_id}")
-async def download_file(resource_id: str, file_id: str):
+async def download_file(resource_id: str, file_id: str, request: Request):
     """
-    Endpoint proxy para descargar archivos de recursos de Nuclia usando el SDK.
-    No expone la API key al frontend.
+    Endpoint proxy para descargar archivos de recursos de Nuclia.
+    No expone la API key al frontend y reenvía el archivo por chunks
+    a medida que llega desde Nuclia, sin bloquear el worker.
+    Reenvía el ETag de Nuclia para que el navegador pueda revalidar (304).
     
     Args:
         resource_id: ID del recurso en Nuclia
@@ -133,37 +286,48 @@ async def download_file(resource_id: str, file_id: str):
         StreamingResponse con el archivo
     """
     try:
-        # Obtener el archivo desde Nuclia usando SDK
-        file_data = download_resource_file(resource_id, file_id)
-        
-        # El SDK devuelve un dict con 'content', 'content_type', 'size'
-        content = file_data['content']
-        content_type = file_data.get('content_type', 'application/octet-stream')
-        
-        # Construir nombre de archivo
-        content_disposition = f'attachment; filename="{resource_id}_{file_id}.pdf"'
-        
-        # Crear un generador para streaming desde bytes
-        def iter_bytes():
-            chunk_size = 8192
-            for i in range(0, len(content), chunk_size):
-                yield content[i:i + chunk_size]
-        
-        # Retornar como StreamingResponse
-        return StreamingResponse(
-            iter_bytes(),
-            media_type=content_type,
-            headers={
-                "Content-Disposition": content_disposition,
-                "Content-Length": str(len(content)),
-                "Cache-Control": "private, max-age=3600",  # Cache por 1 hora
-            }
+        # Abrir la descarga desde Nuclia en modo streaming
+        r = await download_resource_file(
+            resource_id,
+            file_id,
+            if_none_match=request.headers.get("if-none-match"),
         )
-        
     except Exception as e:
         raise HTTPException(
             status_code=500, 
             detail=f"Error descargando archivo: {str(e)}"
         )
+    
+    headers = {
+        "Cache-Control": "private, max-age=3600",  # Cache por 1 hora
+    }
+    if "etag" in r.headers:
+        headers["ETag"] = r.headers["etag"]
+    
+    # El archivo del cliente sigue vigente
+    if r.status_code == 304:
+        await r.aclose()
+        return Response(status_code=304, headers=headers)
+    
+    content_type = r.headers.get("content-type", "application/octet-stream")
+    
+    # Usar el nombre que envía Nuclia o construir uno
+    headers["Content-Disposition"] = r.headers.get(
+        "content-disposition",
+        f'attachment; filename="{resource_id}_{file_id}.pdf"'
+    )
+    # Se reenvían los bytes tal como llegan (sin decodificar gzip), así
+    # Content-Length y Content-Encoding siguen siendo válidos
+    for name in ("content-length", "content-encoding"):
+        if name in r.headers:
+            headers[name.title()] = r.headers[name]
+    
+    # Retornar como StreamingResponse; la conexión con Nuclia se cierra al terminar
+    return StreamingResponse(
+        r.aiter_raw(chunk_size=65536),
+        media_type=content_type,
+        headers=headers,
+        background=BackgroundTask(r.aclose),
+    )
 
 
@@ -1,10 +1,83 @@
-import requests
+import asyncio
+import logging
+import time
+import httpx
+import orjson
 from nuclia import sdk
+from .clients import ASYNC_HTTP
 from .config import NUCLIA_API_BASE, KB, HEADERS, NUCLIA_TOKEN
+from .cache import TTLCache, ttl_cached
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional, List, Dict, Any
+from types import MappingProxyType
+from urllib.parse import urlencode
 import base64
 
 
+log = logging.getLogger(__name__)
+
+# Mapeo vacío inmutable y compartido para los .get(...) anidados (evita crear un {} por llamada)
+EMPTY_MAP = MappingProxyType({})
+
+
+# ── Reintentos por status: httpx solo reintenta errores de conexión, así que los
+# GET idempotentes se reintentan aquí ante rate limit / gateway (backoff exponencial)
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+_STATUS_RETRIES = 3
+_BACKOFF_FACTOR = 0.3
+_MAX_BACKOFF = 10.0
+
+
+class _StatusRetryTransport(httpx.HTTPTransport):
+    """HTTPTransport que reintenta GET/HEAD ante 429/502/503/504, respetando Retry-After."""
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(_STATUS_RETRIES):
+            response = super().handle_request(request)
+            if request.method not in ("GET", "HEAD") or response.status_code not in _RETRY_STATUSES:
+                return response
+            
+            retry_after = response.headers.get("retry-after", "")
+            delay = float(retry_after) if retry_after.isdigit() else _BACKOFF_FACTOR * 2 ** attempt
+            response.close()
+            log.debug("Nuclia respondió %s; reintento %d en %.1fs", response.status_code, attempt + 1, delay)
+            time.sleep(min(delay, _MAX_BACKOFF))
+        
+        return super().handle_request(request)
+
+
+# ── Cliente HTTP compartido con Nuclia (HTTP/2 + keep-alive + pool de conexiones)
+# HTTP/2 multiplexa las llamadas concurrentes que pasan por este cliente (búsqueda,
+# /ask de Nuclia, fallback de recursos) sobre una sola conexión TLS. Los recursos y
+# las URLs temporales se piden con el SDK (sdk.NucliaResource), que usa sus propias
+# conexiones; las descargas van por ASYNC_HTTP.
+NUCLIA_HTTP = httpx.Client(
+    base_url=NUCLIA_API_BASE,
+    headers=HEADERS,
+    timeout=30,
+    transport=_StatusRetryTransport(
+        http2=True,
+        retries=3,  # Reintentos ante errores de conexión
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    ),
+)
+
+# ── Pool acotado para las llamadas al SDK de Nuclia (respeta los rate limits)
+NUCLIA_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="nuclia-sdk")
+
+
+# ── Cachés en memoria para metadata de recursos y URLs temporales
+# La metadata de un recurso casi no cambia; las URLs temporales se guardan
+# 10 minutos menos que su TTL para no entregar URLs a punto de expirar.
+RESOURCE_CACHE = TTLCache(maxsize=1024, ttl=1800)
+DOWNLOAD_URL_CACHE = TTLCache(maxsize=1024, ttl=3000)
+_DOWNLOAD_URL_MARGIN = 600
+
+# Máximo de redirects al descargar un archivo (Nuclia suele redirigir al storage)
+_MAX_DOWNLOAD_REDIRECTS = 5
+
+
 # ── Inicializar SDK de Nuclia (se hace una vez al importar el módulo)
 def _init_nuclia_sdk():
     """Inicializa el SDK de Nuclia con la API key y URL."""
@@ -14,12 +87,58 @@ def _init_nuclia_sdk():
         sdk.NucliaAuth().url(NUCLIA_API_BASE).api_key(NUCLIA_TOKEN).kb(KB)
         return True
     except Exception as e:
-        print(f"Warning: No se pudo inicializar SDK de Nuclia: {e}")
+        log.warning("No se pudo inicializar SDK de Nuclia: %s", e)
         return False
 
 # Inicializar al importar
 _SDK_INITIALIZED = _init_nuclia_sdk()
 
+# ── Parámetros fijos de búsqueda (precodificados por combinación de opciones)
+_SEARCH_PATH = f"/kb/{KB}/search"
+_DEFAULT_FEATURES = ("keyword", "semantic")
+_DEFAULT_SHOW = ("basic", "values", "origin")
+
+
+@lru_cache(maxsize=64)
+def _encode_search_params(
+    features: tuple,
+    vectorset: str,
+    show: tuple,
+    filters: tuple,
+    faceted: tuple,
+    sort: Optional[str],
+    min_score: Optional[float]
+) -> str:
+    """Codifica la parte estable de la query string de /search (todo menos query y size)."""
+    params: Dict[str, Any] = {
+        "show": list(show),
+        # Búsqueda híbrida por defecto (keyword + semantic)
+        "features": list(features),
+    }
+    
+    # Vectorset para búsqueda semántica
+    if "semantic" in features:
+        params["vectorset"] = vectorset
+    
+    # Filtros opcionales
+    if filters:
+        params["filters"] = list(filters)
+    
+    # Facetado
+    if faceted:
+        params["faceted"] = list(faceted)
+    
+    # Ordenamiento
+    if sort:
+        params["sort"] = sort
+    
+    # Score mínimo
+    if min_score is not None:
+        params["min_score"] = min_score
+    
+    return urlencode(params, doseq=True)
+
+
 # ── Búsqueda Nuclia mejorada
 def nuclia_search(
     query: str, 
@@ -29,7 +148,8 @@ def nuclia_search(
     faceted: Optional[List[str]] = None,
     sort: Optional[str] = None,
     min_score: Optional[float] = None,
-    vectorset: str = "multilingual-2024-05-06"
+    vectorset: str = "multilingual-2024-05-06",
+    show: Optional[List[str]] = None
 ) -> dict:
     """
     Búsqueda mejorada en Nuclia con múltiples opciones.
@@ -43,46 +163,29 @@ def nuclia_search(
         sort: Ordenamiento ('created', 'modified', 'score')
         min_score: Score mínimo para resultados (0.0-1.0)
         vectorset: Conjunto de vectores para búsqueda semántica
+        show: Secciones de cada recurso a incluir en la respuesta
+              (default: basic, values, origin; así ya vienen los archivos)
     """
-    url = f"{NUCLIA_API_BASE}/kb/{KB}/search"
-    
-    # Parámetros base
-    params: Dict[str, Any] = {
-        "query": query,
-        "size": size,
-    }
-    
-    # Búsqueda híbrida por defecto (keyword + semantic)
-    if features is None:
-        features = ["keyword", "semantic"]
-    params["features"] = features
-    
-    # Vectorset para búsqueda semántica
-    if "semantic" in features:
-        params["vectorset"] = vectorset
-    
-    # Filtros opcionales
-    if filters:
-        params["filters"] = filters
-    
-    # Facetado
-    if faceted:
-        params["faceted"] = faceted
-    
-    # Ordenamiento
-    if sort:
-        params["sort"] = sort
-    
-    # Score mínimo
-    if min_score is not None:
-        params["min_score"] = min_score
+    # Solo query y size cambian entre llamadas; el resto de la query string
+    # se codifica una vez por combinación de opciones y se reutiliza
+    static_params = _encode_search_params(
+        tuple(features) if features is not None else _DEFAULT_FEATURES,
+        vectorset,
+        tuple(show) if show is not None else _DEFAULT_SHOW,
+        tuple(filters or ()),
+        tuple(faceted or ()),
+        sort,
+        min_score,
+    )
+    query_string = urlencode({"query": query, "size": size})
     
-    r = requests.get(url, headers=HEADERS, params=params, timeout=30)
+    r = NUCLIA_HTTP.get(f"{_SEARCH_PATH}?{query_string}&{static_params}")
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
 # ── Obtener recurso específico de Nuclia usando SDK
+@ttl_cached(RESOURCE_CACHE, key=lambda resource_id: resource_id)
 def get_nuclia_resource(resource_id: str) -> dict:
     """
     Obtiene información completa de un recurso específico de Nuclia usando el SDK.
@@ -99,15 +202,77 @@ def get_nuclia_resource(resource_id: str) -> dict:
         data = resource.get(rid=resource_id, show=["basic", "values", "origin"])
         return data
     except Exception as e:
-        print(f"Error obteniendo recurso {resource_id} con SDK: {e}")
-        # Fallback a requests si el SDK falla
-        url = f"{NUCLIA_API_BASE}/kb/{KB}/resource/{resource_id}"
-        r = requests.get(url, headers=HEADERS, timeout=30)
+        log.warning("Error obteniendo recurso %s con SDK: %s", resource_id, e)
+        # Fallback a la API HTTP si el SDK falla
+        r = NUCLIA_HTTP.get(f"/kb/{KB}/resource/{resource_id}")
         r.raise_for_status()
-        return r.json()
+        return orjson.loads(r.content)
+
+
+# ── Obtener varios recursos de una vez (caché + llamadas concurrentes al SDK)
+def batch_get_resources(resource_ids: List[str]) -> Dict[str, dict]:
+    """
+    Obtiene varios recursos en un solo paso. Los que ya están en caché no
+    generan llamadas; los demás se piden en paralelo en el pool del SDK.
+    
+    Args:
+        resource_ids: IDs de los recursos (se ignoran duplicados)
+        
+    Returns:
+        dict resource_id -> recurso. Los recursos que fallan se omiten.
+    """
+    futures = {
+        rid: NUCLIA_POOL.submit(get_nuclia_resource, rid)
+        for rid in dict.fromkeys(resource_ids)
+    }
+    
+    results = {}
+    for rid, future in futures.items():
+        try:
+            results[rid] = future.result()
+        except Exception as e:
+            log.warning("Error obteniendo recurso %s: %s", rid, e)
+    return results
 
 
 # ── Obtener URL temporal de descarga de archivo usando SDK
+def get_temporal_download_url_expiring(
+    resource_id: str,
+    file_id: str,
+    ttl: int = 3600
+) -> tuple[str, Optional[float]]:
+    """
+    Igual que get_temporal_download_url, pero devuelve también hasta cuándo
+    conviene entregar la URL.
+    
+    Returns:
+        (url, usable_until): usable_until es un instante de time.monotonic()
+        (vencimiento del token menos el margen), o None si la URL es la estándar
+        autenticada, que no expira
+    """
+    cache_key = (resource_id, file_id, ttl)
+    cached = DOWNLOAD_URL_CACHE.get(cache_key)
+    if cached:
+        return cached
+    
+    try:
+        # Usar SDK de Nuclia para obtener URL temporal
+        resource = sdk.NucliaResource()
+        url = resource.temporal_download_url(rid=resource_id, file_id=file_id, ttl=ttl)
+        usable_until = time.monotonic() + ttl - _DOWNLOAD_URL_MARGIN
+        # Solo se cachean URLs temporales; el fallback de abajo no se guarda
+        DOWNLOAD_URL_CACHE.set(
+            cache_key,
+            (url, usable_until),
+            ttl=min(DOWNLOAD_URL_CACHE.ttl, ttl - _DOWNLOAD_URL_MARGIN),
+        )
+        return url, usable_until
+    except Exception as e:
+        log.warning("Error obteniendo URL temporal para %s/%s: %s", resource_id, file_id, e)
+        # Si falla, construir URL estándar (requiere autenticación)
+        return f"{NUCLIA_API_BASE}/kb/{KB}/resource/{resource_id}/file/{file_id}/download", None
+
+
 def get_temporal_download_url(resource_id: str, file_id: str, ttl: int = 3600) -> str:
     """
     Obtiene una URL temporal de descarga para un archivo usando el SDK de Nuclia.
@@ -121,15 +286,7 @@ def get_temporal_download_url(resource_id: str, file_id: str, ttl: int = 3600) -
     Returns:
         str con la URL temporal de descarga
     """
-    try:
-        # Usar SDK de Nuclia para obtener URL temporal
-        resource = sdk.NucliaResource()
-        url = resource.temporal_download_url(rid=resource_id, file_id=file_id, ttl=ttl)
-        return url
-    except Exception as e:
-        print(f"Error obteniendo URL temporal para {resource_id}/{file_id}: {e}")
-        # Si falla, construir URL estándar (requiere autenticación)
-        return f"{NUCLIA_API_BASE}/kb/{KB}/resource/{resource_id}/file/{file_id}/download"
+    return get_temporal_download_url_expiring(resource_id, file_id, ttl)[0]
 
 
 # ── Obtener archivo de recurso
@@ -144,16 +301,14 @@ def get_resource_file(resource_id: str, field_id: str = "file") -> dict:
     Returns:
         dict con URL de descarga y metadata del archivo
     """
-    url = f"{NUCLIA_API_BASE}/kb/{KB}/resource/{resource_id}/{field_id}/download"
-    
-    r = requests.get(url, headers=HEADERS, timeout=30)
+    r = NUCLIA_HTTP.get(f"/kb/{KB}/resource/{resource_id}/{field_id}/download")
     r.raise_for_status()
     
     # La respuesta puede ser JSON con URL o puede ser el archivo directamente
     content_type = r.headers.get("content-type", "")
     
     if "application/json" in content_type:
-        return r.json()
+        return orjson.loads(r.content)
     else:
         # Si es el archivo directamente, devolverlo como base64
         return {
@@ -164,96 +319,106 @@ def get_resource_file(resource_id: str, field_id: str = "file") -> dict:
 
 
 # ── Descargar archivo de recurso (proxy para no exponer API key)
-def download_resource_file(resource_id: str, file_id: str):
+async def download_resource_file(
+    resource_id: str,
+    file_id: str,
+    if_none_match: Optional[str] = None
+) -> httpx.Response:
     """
-    Descarga un archivo de un recurso de Nuclia usando el SDK.
-    Según la documentación, debes usar download_file() del SDK, no construir URLs manualmente.
+    Abre la descarga de un archivo de un recurso de Nuclia en modo streaming (async).
+    Usa la URL temporal del SDK (o la URL estándar autenticada si el SDK falla),
+    así el contenido se reenvía por chunks sin cargar el archivo completo en memoria
+    ni bloquear el event loop.
     
     Args:
         resource_id: ID del recurso
         file_id: ID del file field (ej: "15323a97500211296cae8abeb5daec6e")
+        if_none_match: ETag que ya tiene el cliente (Nuclia puede responder 304)
         
     Returns:
-        bytes con el contenido del archivo y metadata
+        httpx.Response abierto en modo stream; el llamador debe cerrarlo con aclose()
     """
-    try:
-        # Usar SDK de Nuclia para descargar
-        import tempfile
-        import os
-        
-        resource = sdk.NucliaResource()
-        
-        # Crear archivo temporal para la descarga
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp_path = tmp.name
-        
-        # Descargar usando SDK
-        resource.download_file(rid=resource_id, file_id=file_id, output=tmp_path)
-        
-        # Leer contenido
-        with open(tmp_path, 'rb') as f:
-            content = f.read()
-        
-        # Limpiar archivo temporal
-        os.unlink(tmp_path)
-        
-        # Retornar contenido y metadata
-        # Nota: El SDK no devuelve headers, así que inferimos el content-type
-        return {
-            'content': content,
-            'content_type': 'application/octet-stream',  # Por defecto
-            'size': len(content)
-        }
-        
-    except Exception as e:
-        print(f"Error descargando archivo con SDK: {e}")
-        raise
+    # El SDK es síncrono: resolver la URL temporal en un thread (normalmente sale de caché)
+    url, usable_until = await asyncio.to_thread(get_temporal_download_url_expiring, resource_id, file_id)
+    
+    # La URL temporal ya trae su token: la API key solo va en la URL estándar
+    headers = dict(HEADERS) if usable_until is None else {}
+    if if_none_match:
+        headers["If-None-Match"] = if_none_match
+    
+    # Redirects a mano: httpx solo quita Authorization al cambiar de origen, no x-api-key
+    request = ASYNC_HTTP.build_request("GET", url, headers=headers)
+    for _ in range(_MAX_DOWNLOAD_REDIRECTS):
+        r = await ASYNC_HTTP.send(request, stream=True, follow_redirects=False)
+        if not r.has_redirect_location:
+            break
+        await r.aclose()
+        next_request = r.next_request
+        if next_request.url.netloc != request.url.netloc or next_request.url.scheme != request.url.scheme:
+            for name in HEADERS:
+                next_request.headers.pop(name, None)
+        request = next_request
+    else:
+        raise httpx.TooManyRedirects("Demasiados redirects descargando archivo", request=request)
+    
+    if r.is_error:
+        await r.aclose()
+        log.warning("Error descargando archivo %s/%s: HTTP %s", resource_id, file_id, r.status_code)
+        r.raise_for_status()
+    return r
 
 
 
-# ── Construcción de contexto mejorada
-def build_context(
+# ── Construcción de contexto y fuentes en una sola pasada
+def build_context_and_sources(
     search_json: dict, 
     max_chunks: int = 20,
-    include_metadata: bool = True,
-    score_threshold: float = 0.0
-) -> str:
+    min_score: float = 0.0,
+    include_metadata: bool = True
+) -> tuple:
     """
-    Construye contexto desde resultados de búsqueda con mejoras.
+    Recorre una sola vez los párrafos de la búsqueda y construye a la vez el
+    contexto para el LLM y la lista base de fuentes para el frontend.
     
     Args:
         search_json: JSON de respuesta de nuclia_search
         max_chunks: Máximo de párrafos a incluir
-        include_metadata: Si incluir título/fuente del documento
-        score_threshold: Score mínimo para incluir un resultado (0.0-1.0)
+        min_score: Score mínimo para incluir un resultado (0.0-1.0)
+        include_metadata: Si incluir título/fuente del documento en el contexto
+    
+    Returns:
+        (context_str, sources). Las fuentes traen los datos del párrafo y del
+        recurso; URLs y datos de descarga se agregan después (agent.enrich_sources).
     """
     para = (search_json.get("paragraphs") or {}).get("results", [])
     resources = (search_json.get("resources") or {})  # Información de archivos
     blocks = []
+    sources = []
     
-    for hit in para[:max_chunks]:
+    for idx, hit in enumerate(para[:max_chunks]):
         # Verificar score si está disponible
-        score = hit.get("score", 1.0)
-        if score < score_threshold:
+        score = hit.get("score")
+        if score is not None and score < min_score:
             continue
             
         text = (hit.get("text") or "").strip()
         if not text:
             continue
         
+        resource_id = hit.get("rid", "")
+        field = hit.get("field", "")
+        
+        # Información del archivo/recurso
+        resource_info = resources.get(resource_id, EMPTY_MAP)
+        title = resource_info.get("title", "")
+        icon = resource_info.get("icon", "")
+        
+        # Obtener número de página si está disponible
+        position = hit.get("position", EMPTY_MAP)
+        page_num = position.get("page_number")
+        
         # Agregar metadata si se solicita
         if include_metadata:
-            resource_id = hit.get("rid", "")
-            field = hit.get("field", "")
-            
-            # Intentar obtener información del archivo/recurso
-            resource_info = resources.get(resource_id, {})
-            title = resource_info.get("title", "")
-            
-            # Obtener número de página si está disponible
-            position = hit.get("position", {})
-            page_num = position.get("page_number")
-            
             # Crear encabezado enriquecido con metadata
             metadata_parts = []
             if title:
@@ -271,8 +436,40 @@ def build_context(
                 blocks.append(text)
         else:
             blocks.append(text)
+        
+        sources.append({
+            "id": idx + 1,
+            "title": title or "Documento sin título",
+            "text": text,
+            "score": round(score, 3) if score else None,
+            "page": page_num,
+            "field": field,
+            "resource_id": resource_id,
+            "resource_type": icon if icon else "unknown",  # Tipo de recurso (MIME type o icon)
+        })
+    
+    return "\n\n---\n\n".join(blocks), sources  # Separador más visible
+
+
+# ── Construcción de contexto mejorada
+def build_context(
+    search_json: dict, 
+    max_chunks: int = 20,
+    include_metadata: bool = True,
+    score_threshold: float = 0.0
+) -> str:
+    """
+    Construye contexto desde resultados de búsqueda con mejoras.
+    Delegada a build_context_and_sources (se conserva por compatibilidad).
     
-    return "\n\n---\n\n".join(blocks)  # Separador más visible
+    Args:
+        search_json: JSON de respuesta de nuclia_search
+        max_chunks: Máximo de párrafos a incluir
+        include_metadata: Si incluir título/fuente del documento
+        score_threshold: Score mínimo para incluir un resultado (0.0-1.0)
+    """
+    context, _ = build_context_and_sources(search_json, max_chunks, score_threshold, include_metadata)
+    return context
 
 
 # ── Funciones para el endpoint /ask de Nuclia
@@ -337,16 +534,14 @@ def nuclia_ask(
     if max_tokens:
         ask_request["max_tokens"] = max_tokens
     
-    # Headers para modo síncrono
-    headers = dict(HEADERS)  # Copiar headers base
+    # Headers para modo síncrono (los headers base ya están en el cliente)
+    headers = {}
     if synchronous:
         headers["x-synchronous"] = "true"
     
     # Llamar al endpoint /ask de Nuclia
-    url = f"{NUCLIA_API_BASE}/kb/{KB}/ask"
-    
-    response = requests.post(
-        url,
+    response = NUCLIA_HTTP.post(
+        f"/kb/{KB}/ask",
         headers=headers,
         json=ask_request,
         timeout=60
@@ -355,7 +550,7 @@ def nuclia_ask(
     
     # Si es síncrono, devolver JSON completo
     if synchronous:
-        return response.json()
+        return orjson.loads(response.content)
     
     # Si es streaming, devolver el generador
     return {"stream": response.iter_lines()}
@@ -369,44 +564,26 @@ def parse_nuclia_ask_response(response: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Dict con 'answer', 'sources', 'metadata', 'citations'
     """
-    result = {
-        "answer": "",
-        "sources": [],
-        "metadata": {},
-        "citations": {},
-        "relations": []
-    }
-    
     # El formato de respuesta síncrona es más directo
-    if "answer" in response:
-        result["answer"] = response["answer"]
-    
-    if "retrieval" in response:
-        # Extraer fuentes de los resultados de búsqueda
-        retrieval = response["retrieval"]
-        if "results" in retrieval:
-            sources = []
-            for idx, item in enumerate(retrieval["results"]):
-                source = {
-                    "id": idx + 1,
-                    "text": item.get("text", ""),
-                    "score": item.get("score"),
-                    "resource_id": item.get("rid"),
-                    "field": item.get("field"),
-                    "title": item.get("title", "Documento sin título")
-                }
-                sources.append(source)
-            result["sources"] = sources
-    
-    if "metadata" in response:
-        result["metadata"] = response["metadata"]
-    
-    if "citations" in response:
-        result["citations"] = response["citations"]
-    
-    if "relations" in response:
-        result["relations"] = response["relations"]
-    
-    return result
-
-
+    retrieval = response.get("retrieval") or {}
+    
+    # Extraer fuentes de los resultados de búsqueda
+    sources = [
+        {
+            "id": idx + 1,
+            "text": item.get("text", ""),
+            "score": item.get("score"),
+            "resource_id": item.get("rid"),
+            "field": item.get("field"),
+            "title": item.get("title", "Documento sin título")
+        }
+        for idx, item in enumerate(retrieval.get("results") or [])
+    ]
+    
+    return {
+        "answer": response.get("answer", ""),
+        "sources": sources,
+        "metadata": response.get("metadata", {}),
+        "citations": response.get("citations", {}),
+        "relations": response.get("relations", [])
+    }
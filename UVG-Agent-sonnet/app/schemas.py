@@ -1,63 +1,150 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from functools import lru_cache
+from typing import Annotated, Literal
+
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from pydantic.dataclasses import dataclass
+
+# Configuración común: ignorar llaves desconocidas, instancias inmutables (hashables)
+# y sin re-validar los valores por defecto en cada construcción.
+# Las dataclasses reciben frozen en el decorador, no en la config.
+_DATACLASS_CONFIG = ConfigDict(extra="ignore", validate_default=False)
+_BODY_CONFIG = ConfigDict(_DATACLASS_CONFIG, frozen=True)
+
+# Umbral de relevancia normalizado (0.0-1.0), validado por pydantic
+Score = Annotated[float, Field(ge=0.0, le=1.0)]
 
 # ── Esquemas mejorados
 class AskBody(BaseModel):
+    model_config = _BODY_CONFIG
+
     query: str = Field(..., min_length=2, max_length=2000)
-    size: Optional[int] = Field(default=30, ge=1, le=100)        # cuántos resultados pedir a Nuclia
-    max_chunks: Optional[int] = Field(default=20, ge=1, le=50)   # cuántos párrafos meter al contexto
-    use_semantic: Optional[bool] = Field(default=True)           # búsqueda semántica + keyword
-    min_score: Optional[float] = Field(default=0.0, ge=0.0, le=1.0)  # score mínimo
+    size: int | None = Field(default=30, ge=1, le=100)            # cuántos resultados pedir a Nuclia
+    max_chunks: int | None = Field(default=20, ge=1, le=50)       # cuántos párrafos meter al contexto
+    use_semantic: bool | None = Field(default=True)               # búsqueda semántica + keyword
+    min_score: Score | None = Field(default=0.0)                  # score mínimo
 
 
 # ── Esquema para contexto conversacional del chatbot
-class ConversationContext(BaseModel):
-    author: str = Field(..., description="USER o NUCLIA")
+#    (dataclass con slots: puede haber muchas entradas por request y no necesitan __dict__)
+@dataclass(frozen=True, slots=True, config=_DATACLASS_CONFIG)
+class ConversationContext:
+    author: Literal["USER", "NUCLIA"] = Field(..., description="USER o NUCLIA")
     text: str = Field(..., description="Mensaje del usuario o respuesta de NUCLIA")
 
 
-# ── Esquema para prompts personalizados
-class CustomPrompt(BaseModel):
-    system: Optional[str] = Field(None, description="System prompt para el comportamiento del modelo")
-    user: Optional[str] = Field(None, description="User prompt con {context} y {question}")
-    rephrase: Optional[str] = Field(None, description="Rephrase prompt para optimizar búsqueda")
+# ── Esquema para prompts personalizados (dataclass con slots, igual que ConversationContext)
+@dataclass(frozen=True, slots=True, config=_DATACLASS_CONFIG)
+class CustomPrompt:
+    system: str | None = Field(None, description="System prompt para el comportamiento del modelo")
+    user: str | None = Field(None, description="User prompt con {context} y {question}")
+    rephrase: str | None = Field(None, description="Rephrase prompt para optimizar búsqueda")
 
 
 # ── Esquema para el endpoint /nuclia-ask (usando el SDK de Nuclia)
 class NucliaAskBody(BaseModel):
+    model_config = _BODY_CONFIG
+
     query: str = Field(..., min_length=2, max_length=2000, description="Pregunta del usuario")
-    context: Optional[List[ConversationContext]] = Field(
+    context: list[ConversationContext] | None = Field(
         default=None, 
         description="Contexto conversacional para chatbot (historial de mensajes)"
     )
-    rephrase: Optional[bool] = Field(
+    rephrase: bool | None = Field(
         default=False, 
         description="Si reprocesar la pregunta usando el contexto para mejorar búsqueda"
     )
-    citations: Optional[str] = Field(
+    citations: Literal["default", "llm_footnotes"] | None = Field(
         default=None, 
         description="Formato de citaciones: 'default', 'llm_footnotes', o None"
     )
-    filters: Optional[List[str]] = Field(
+    filters: list[str] | None = Field(
         default=None, 
         description="Filtros de búsqueda (ej: ['/classification.labels/tipo/documento'])"
     )
-    prompt: Optional[CustomPrompt] = Field(
+    prompt: CustomPrompt | None = Field(
         default=None, 
         description="Prompts personalizados (system, user, rephrase)"
     )
-    synchronous: Optional[bool] = Field(
+    synchronous: bool | None = Field(
         default=True, 
         description="Si devolver respuesta completa (True) o streaming (False)"
     )
-    features: Optional[List[str]] = Field(
+    features: list[Literal["keyword", "semantic", "relations"]] | None = Field(
         default=None,
         description="Features de búsqueda: ['keyword', 'semantic', 'relations']"
     )
-    max_tokens: Optional[int] = Field(
+    max_tokens: int | None = Field(
         default=None,
         ge=1,
         le=4096,
         description="Número máximo de tokens en la respuesta generada"
     )
 
+
+# ── Esquemas de las fuentes que arma extract_sources_info / enrich_sources
+class FileInfo(BaseModel):
+    model_config = _BODY_CONFIG
+
+    download_url: str | None = None
+    content_type: str | None = None
+    size: int | None = None
+    filename: str | None = None
+    file_id: str | None = None
+    ttl: int | None = None  # Segundos de validez restantes de la URL (None: no vence)
+    kind: Literal["pdf", "excel", "other"] = "other"  # Clasificación por content type
+    is_pdf: bool = False
+    is_excel: bool = False
+
+
+class SourceInfo(BaseModel):
+    model_config = _BODY_CONFIG
+
+    id: int | None = None
+    title: str | None = None
+    text: str = ""
+    score: float | None = None  # Los scores de Nuclia no están acotados a [0, 1]
+    page: int | None = None
+    field: str | None = None
+    resource_id: str | None = None
+    resource_type: str | None = None
+    url: str | None = None
+    url_type: str | None = None
+    has_url: bool = False
+    is_downloadable: bool = False
+    file: FileInfo | None = None
+
+
+# ── Validadores precompilados: FastAPI los usa con validate_json(bytes) para que
+#    pydantic-core parsee y valide el body en una sola pasada, sin json.loads.
+#    Los bodies se validan solo ahí: el resto del pipeline (ask_agent, nuclia_ask)
+#    recibe valores ya validados y no vuelve a construir modelos. Si algún código
+#    interno necesitara armar un AskBody/NucliaAskBody a partir de datos propios,
+#    usar Model.model_construct(**data) (sin validación); nunca con datos del cliente.
+ASK_BODY_ADAPTER = TypeAdapter(AskBody)
+NUCLIA_ASK_BODY_ADAPTER = TypeAdapter(NucliaAskBody)
+
+# Lista de fuentes validada de una vez (acceso por atributo en vez de .get encadenados)
+SOURCES_ADAPTER = TypeAdapter(list[SourceInfo])
+
+# ── JSON Schema de los bodies para OpenAPI (se genera una sola vez)
+_OPENAPI_REF_TEMPLATE = "#/components/schemas/{model}"
+
+
+@lru_cache(maxsize=1)
+def ask_body_schema() -> dict:
+    """JSON Schema de AskBody; los sub-esquemas quedan en $defs con refs a components."""
+    return AskBody.model_json_schema(ref_template=_OPENAPI_REF_TEMPLATE)
+
+
+@lru_cache(maxsize=1)
+def nuclia_ask_body_schema() -> dict:
+    """JSON Schema de NucliaAskBody; los sub-esquemas quedan en $defs con refs a components."""
+    return NucliaAskBody.model_json_schema(ref_template=_OPENAPI_REF_TEMPLATE)
+
+
+# Forzar a que validadores y serializadores existan al importar el módulo (y no en
+# el primer request). Si algún esquema quedó diferido o incompleto, falla aquí.
+for _model in (AskBody, NucliaAskBody, SourceInfo):
+    _model.__pydantic_validator__
+    _model.__pydantic_serializer__
+del _model
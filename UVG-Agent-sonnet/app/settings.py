@@ -18,6 +18,12 @@ class Settings:
     ANTHROPIC_KEY: str = _clean(os.getenv("ANTHROPIC_KEY"))
     CLAUDE_MODEL: str = _clean(os.getenv("CLAUDE_MODEL") or "claude-sonnet-4-0")
 
+    # Debug: incluye respuestas crudas de Nuclia en la API (pesadas, solo para desarrollo)
+    DEBUG: bool = _clean(os.getenv("DEBUG")).lower() in ("1", "true", "yes")
+
+    # Nivel de logging (DEBUG muestra cada llamada al SDK de Nuclia)
+    LOG_LEVEL: str = _clean(os.getenv("LOG_LEVEL") or "WARNING").upper()
+
     # Instrucciones del sistema
     INSTRUCTIONS: str = _clean(os.getenv("INSTRUCTIONS") or "Eres un asesor académico de la UVG Altiplano. Responde usando solo el contexto dado. Si no hay info suficiente, dilo.")
 
@@ -2,21 +2,36 @@
 """
 Script de prueba para verificar que el sistema obtiene automáticamente 
 la información de PDFs desde los recursos de Nuclia.
+
+Requiere las dependencias de desarrollo: pip install -r requirements-dev.txt
 """
 
 from app.agent import ask_agent
-import json
+import asyncio
+import sys
+import traceback
+from operator import itemgetter
+import aiofiles
+import orjson
+
+# Llaves que build_context_and_sources garantiza en cada fuente (una sola llamada en C)
+_source_fields = itemgetter('id', 'title', 'resource_id', 'score', 'page')
+_file_fields = itemgetter('download_url', 'content_type', 'size', 'filename')
 
-def test_pdf_retrieval():
+async def test_pdf_retrieval():
     """Prueba que el sistema obtiene automáticamente información de PDFs"""
     
+    # Acumular la salida y escribirla de una vez al final (un solo write)
+    buf: list[str] = []
+    _a = buf.append
+    
     # Hacer una consulta que probablemente devuelva PDFs
     question = "¿Qué información tienes sobre documentos?"
     
-    print(f"🔍 Consultando: {question}\n")
+    _a(f"🔍 Consultando: {question}\n")
     
     try:
-        result = ask_agent(
+        result = await ask_agent(
             question=question,
             size=10,
             max_chunks=5,
@@ -24,46 +39,55 @@ def test_pdf_retrieval():
             min_score=0.0
         )
         
-        print(f"✅ Respuesta recibida\n")
-        print(f"📝 Respuesta: {result['answer'][:200]}...\n")
+        _a(f"✅ Respuesta recibida\n")
+        _a(f"📝 Respuesta: {result['answer'][:200]}...\n")
         
-        # Verificar si hay PDFs en las fuentes
-        pdf_sources = [s for s in result['sources'] if s.get('is_pdf')]
+        # Una sola pasada: los datos de PDF viven en source["file"]
+        pdf_count = 0
+        pdf_lines = []
+        source_lines = []
+        for source in result['sources']:
+            source_id, title, resource_id, score, page = _source_fields(source)
+            file_info = source.get('file') or {}
+            is_pdf = file_info.get('kind') == 'pdf'
+            if is_pdf:
+                pdf_count += 1
+                download_url, content_type, size, filename = _file_fields(file_info)
+                pdf_lines.append(f"  - {title}")
+                pdf_lines.append(f"    Resource ID: {resource_id}")
+                pdf_lines.append(f"    Download URL: {download_url}")
+                pdf_lines.append(f"    Content Type: {content_type}")
+                pdf_lines.append(f"    Size: {size} bytes")
+                pdf_lines.append(f"    Filename: {filename}")
+            source_lines.append(f"  {source_id}. {title}")
+            source_lines.append(f"     Score: {score}, Page: {page}")
+            source_lines.append(f"     PDF: {'Sí' if is_pdf else 'No'}")
         
-        if pdf_sources:
-            print(f"📄 Se encontraron {len(pdf_sources)} PDFs:\n")
-            for source in pdf_sources:
-                print(f"  - {source['title']}")
-                print(f"    Resource ID: {source['resource_id']}")
-                if 'pdf' in source:
-                    pdf_info = source['pdf']
-                    print(f"    Download URL: {pdf_info['download_url']}")
-                    print(f"    Content Type: {pdf_info['content_type']}")
-                    print(f"    Size: {pdf_info['size']} bytes")
-                    print(f"    Filename: {pdf_info['filename']}")
-                print()
+        if pdf_count:
+            _a(f"📄 Se encontraron {pdf_count} PDFs:\n")
+            buf.extend(pdf_lines)
+            _a("")
         else:
-            print("ℹ️  No se encontraron PDFs en los resultados\n")
+            _a("ℹ️  No se encontraron PDFs en los resultados\n")
         
         # Mostrar todas las fuentes
-        print(f"📚 Total de fuentes: {len(result['sources'])}\n")
-        for source in result['sources']:
-            print(f"  {source['id']}. {source['title']}")
-            print(f"     Score: {source['score']}, Page: {source.get('page', 'N/A')}")
-            print(f"     PDF: {'Sí' if source.get('is_pdf') else 'No'}")
-            print()
+        _a(f"📚 Total de fuentes: {len(result['sources'])}\n")
+        buf.extend(source_lines)
+        _a("")
         
-        # Guardar resultado completo para inspección
-        with open('test_result.json', 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        # Guardar resultado completo para inspección (sin bloquear el event loop)
+        async with aiofiles.open('test_result.json', 'wb') as f:
+            await f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         
-        print("💾 Resultado completo guardado en test_result.json")
+        _a("💾 Resultado completo guardado en test_result.json")
         
     except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        _a(f"❌ Error: {e}")
+        _a(traceback.format_exc())
+    finally:
+        sys.stdout.write("\n".join(buf))
+        sys.stdout.write("\n")
 
 
 if __name__ == "__main__":
-    test_pdf_retrieval()
+    asyncio.run(test_pdf_retrieval())
@@ -6,151 +6,179 @@ Este script simula cómo el agente obtiene automáticamente URLs temporales
 de descarga para archivos.
 """
 
-import json
+import os
+import sys
+import traceback
+from functools import cache
+
+import orjson
 from app.agent import extract_sources_info
+from app.schemas import SOURCES_ADAPTER
+
+
+@cache
+def _load_response(path: str, mtime_ns: int) -> dict:
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def load_response(path: str = "response.json") -> dict:
+    """
+    Carga el JSON de respuesta de ejemplo. El parseo se memoiza por (ruta, mtime):
+    si el archivo no cambió, las siguientes llamadas en el mismo proceso no lo releen.
+    """
+    return _load_response(path, os.stat(path).st_mtime_ns)
+
 
-def test_extract_sources_from_response():
+def test_extract_sources_from_response(verbose: bool = False):
     """
     Prueba la extracción de fuentes y URLs de descarga usando el SDK de Nuclia.
     IMPORTANTE: Este test hace llamadas reales al SDK de Nuclia para obtener
     URLs temporales de descarga.
     """
-    # Cargar el JSON de respuesta de ejemplo
-    with open("response.json", "r", encoding="utf-8") as f:
-        response_data = json.load(f)
-    
-    print("=" * 80)
-    print("TEST: Extracción con SDK de Nuclia - URLs Temporales de Descarga")
-    print("=" * 80)
-    print("\n⚠️  NOTA: Este test hace llamadas reales a la API de Nuclia")
-    print("    para obtener URLs temporales de descarga.\n")
-    
-    # Extraer sources (esto hará llamadas al SDK para archivos)
-    sources = extract_sources_info(
-        response_data,
-        max_chunks=10,
-        score_threshold=0.0
-    )
+    # Acumular la salida y escribirla de una vez al final (un solo write)
+    buf: list[str] = []
+    _a = buf.append
+    _sep = _a if verbose else (lambda line: None)  # Separadores solo con --verbose
     
-    print(f"\n✅ Se extrajeron {len(sources)} fuentes\n")
-    
-    # Analizar cada fuente
-    downloadable_count = 0
-    link_count = 0
-    
-    for idx, source in enumerate(sources, 1):
-        print(f"\n{'='*60}")
-        print(f"Fuente #{idx}")
-        print(f"{'='*60}")
-        print(f"Título: {source.get('title')}")
-        print(f"Tipo: {source.get('resource_type')}")
-        print(f"Resource ID: {source.get('resource_id')}")
-        print(f"Score: {source.get('score')}")
-        if source.get('page'):
-            print(f"Página: {source.get('page')}")
+    try:
+        # Cargar el JSON de respuesta de ejemplo
+        response_data = load_response()
+        
+        _sep("=" * 80)
+        _a("TEST: Extracción con SDK de Nuclia - URLs Temporales de Descarga")
+        _sep("=" * 80)
+        _a("\n⚠️  NOTA: Este test hace llamadas reales a la API de Nuclia")
+        _a("    para obtener URLs temporales de descarga.\n")
+        
+        # Extraer sources (esto hará llamadas al SDK para archivos)
+        # Validar la lista una sola vez y leer las fuentes por atributo
+        sources = SOURCES_ADAPTER.validate_python(extract_sources_info(
+            response_data,
+            max_chunks=10,
+            score_threshold=0.0
+        ))
         
-        if source.get('is_downloadable'):
-            downloadable_count += 1
-            file_info = source.get('file', {})
-            print(f"\n📥 ARCHIVO DESCARGABLE (con URL temporal):")
-            print(f"  - URL Temporal: {file_info.get('download_url')[:80]}...")
-            print(f"  - Content Type: {file_info.get('content_type')}")
-            print(f"  - Tamaño: {file_info.get('size')} bytes ({file_info.get('size', 0) / 1024:.2f} KB)")
-            print(f"  - Nombre: {file_info.get('filename')}")
-            print(f"  - File ID: {file_info.get('file_id')}")
-            print(f"  - TTL: {file_info.get('ttl', 3600)} segundos")
-            print(f"  - Es PDF: {'✅' if file_info.get('is_pdf') else '❌'}")
-            print(f"  - Es Excel: {'✅' if file_info.get('is_excel') else '❌'}")
+        _a(f"\n✅ Se extrajeron {len(sources)} fuentes\n")
+        
+        # Analizar cada fuente (conteos y URLs en la misma pasada)
+        downloadable_count = link_count = pdf_count = 0
+        temporal_urls = []
+        first_downloadable = None
+        
+        for idx, source in enumerate(sources, 1):
+            _sep(f"\n{'='*60}")
+            _a(f"Fuente #{idx}")
+            _sep(f"{'='*60}")
+            _a(f"Título: {source.title}")
+            _a(f"Tipo: {source.resource_type}")
+            _a(f"Resource ID: {source.resource_id}")
+            _a(f"Score: {source.score}")
+            if source.page:
+                _a(f"Página: {source.page}")
+        
+            if source.is_downloadable:
+                downloadable_count += 1
+                file_info = source.file
+                pdf_count += file_info.kind == "pdf"
+                if file_info.download_url:
+                    temporal_urls.append(file_info.download_url)
+                if first_downloadable is None:
+                    first_downloadable = source
+                _a(f"\n📥 ARCHIVO DESCARGABLE (con URL temporal):")
+                _a(f"  - URL Temporal: {file_info.download_url[:80]}...")
+                _a(f"  - Content Type: {file_info.content_type}")
+                _a(f"  - Tamaño: {file_info.size} bytes ({(file_info.size or 0) / 1024:.2f} KB)")
+                _a(f"  - Nombre: {file_info.filename}")
+                _a(f"  - File ID: {file_info.file_id}")
+                _a(f"  - TTL: {file_info.ttl} segundos")
+                match file_info.kind:
+                    case "pdf":
+                        _a("  - Tipo de archivo: 📕 PDF")
+                    case "excel":
+                        _a("  - Tipo de archivo: 📊 Excel")
+                    case _:
+                        _a("  - Tipo de archivo: 📄 Otro")
             
-            # Validar que la URL es temporal (contiene token)
-            if 'token' in file_info.get('download_url', '').lower():
-                print(f"  ✅ URL contiene token temporal")
-            else:
-                print(f"  ℹ️  URL estándar (puede requerir autenticación)")
+                # Validar que la URL es temporal (contiene token)
+                if 'token' in (file_info.download_url or '').lower():
+                    _a(f"  ✅ URL contiene token temporal")
+                else:
+                    _a(f"  ℹ️  URL estándar (puede requerir autenticación)")
                 
-        elif source.get('resource_type') == 'application/stf-link':
-            link_count += 1
-            print(f"\n🔗 ENLACE WEB")
-            print(f"  - URL: {source.get('url')}")
+            elif source.resource_type == 'application/stf-link':
+                link_count += 1
+                _a(f"\n🔗 ENLACE WEB")
+                _a(f"  - URL: {source.url}")
+            else:
+                _a(f"\n📄 Otro tipo de recurso")
+                _a(f"  - URL: {source.url}")
+        
+            # Mostrar extracto del texto
+            text_preview = source.text[:150].replace('\n', ' ')
+            _a(f"\n📝 Extracto:")
+            _a(f"   {text_preview}...")
+        
+        # Resumen
+        _sep("\n" + "=" * 80)
+        _a("📊 RESUMEN")
+        _sep("=" * 80)
+        _a(f"Total de fuentes: {len(sources)}")
+        _a(f"Archivos descargables: {downloadable_count} ({pdf_count} PDF)")
+        _a(f"Enlaces web: {link_count}")
+        _a(f"Otros: {len(sources) - downloadable_count - link_count}")
+        
+        # Validación
+        _sep("\n" + "=" * 80)
+        _a("✔️  VALIDACIÓN")
+        _sep("=" * 80)
+        
+        if len(temporal_urls) == downloadable_count:
+            _a("✅ Todos los archivos descargables tienen download_url")
         else:
-            print(f"\n📄 Otro tipo de recurso")
-            print(f"  - URL: {source.get('url')}")
+            _a("❌ Algunos archivos descargables no tienen download_url")
         
-        # Mostrar extracto del texto
-        text_preview = source.get('text', '')[:150].replace('\n', ' ')
-        print(f"\n📝 Extracto:")
-        print(f"   {text_preview}...")
-    
-    # Resumen
-    print("\n" + "=" * 80)
-    print("📊 RESUMEN")
-    print("=" * 80)
-    print(f"Total de fuentes: {len(sources)}")
-    print(f"Archivos descargables: {downloadable_count}")
-    print(f"Enlaces web: {link_count}")
-    print(f"Otros: {len(sources) - downloadable_count - link_count}")
-    
-    # Validación
-    print("\n" + "=" * 80)
-    print("✔️  VALIDACIÓN")
-    print("=" * 80)
-    
-    all_downloadable_have_urls = all(
-        source.get('file', {}).get('download_url') 
-        for source in sources 
-        if source.get('is_downloadable')
-    )
-    
-    if all_downloadable_have_urls:
-        print("✅ Todos los archivos descargables tienen download_url")
-    else:
-        print("❌ Algunos archivos descargables no tienen download_url")
-    
-    # Verificar que se obtuvieron URLs temporales
-    temporal_urls = [
-        source.get('file', {}).get('download_url')
-        for source in sources
-        if source.get('is_downloadable')
-    ]
-    
-    if temporal_urls:
-        print(f"✅ Se obtuvieron {len(temporal_urls)} URLs temporales de descarga")
-        print(f"   TTL: 3600 segundos (1 hora)")
-    
-    # Mostrar ejemplo de uso
-    print("\n" + "=" * 80)
-    print("💡 EJEMPLO DE USO")
-    print("=" * 80)
-    
-    for source in sources:
-        if source.get('is_downloadable'):
-            file_info = source.get('file', {})
-            temporal_url = file_info.get('download_url')
-            print(f"\nPara descargar: {source.get('title')}")
-            print(f"\n1. URL Temporal (válida por 1 hora, no requiere auth):")
-            print(f"   {temporal_url}")
-            print(f"\n2. Esta URL puede usarse directamente desde el frontend:")
-            print(f"   fetch('{temporal_url}')")
-            print(f"     .then(r => r.blob())")
-            print(f"     .then(blob => {{")
-            print(f"       // Descargar archivo")
-            print(f"     }})")
-            break
-    
-    print("\n" + "=" * 80)
-    print("✅ TEST COMPLETADO")
-    print("=" * 80)
-    
-    return sources
+        # Verificar que se obtuvieron URLs temporales
+        if temporal_urls:
+            _a(f"✅ Se obtuvieron {len(temporal_urls)} URLs temporales de descarga")
+            ttls = [s.file.ttl for s in sources if s.is_downloadable and s.file.ttl is not None]
+            if ttls:
+                _a(f"   TTL restante: {min(ttls)}-{max(ttls)} segundos")
+        
+        # Mostrar ejemplo de uso
+        _sep("\n" + "=" * 80)
+        _a("💡 EJEMPLO DE USO")
+        _sep("=" * 80)
+        
+        if first_downloadable is not None:
+            source = first_downloadable
+            temporal_url = source.file.download_url
+            _a(f"\nPara descargar: {source.title}")
+            _a(f"\n1. URL Temporal (válida por 1 hora, no requiere auth):")
+            _a(f"   {temporal_url}")
+            _a(f"\n2. Esta URL puede usarse directamente desde el frontend:")
+            _a(f"   fetch('{temporal_url}')")
+            _a(f"     .then(r => r.blob())")
+            _a(f"     .then(blob => {{")
+            _a(f"       // Descargar archivo")
+            _a(f"     }})")
+        
+        _sep("\n" + "=" * 80)
+        _a("✅ TEST COMPLETADO")
+        _sep("=" * 80)
+        
+        return sources
+    finally:
+        sys.stdout.write("\n".join(buf))
+        sys.stdout.write("\n")
 
 
 if __name__ == "__main__":
     try:
-        sources = test_extract_sources_from_response()
+        sources = test_extract_sources_from_response(verbose="--verbose" in sys.argv)
         print(f"\n🎉 Éxito: Se procesaron {len(sources)} fuentes correctamente")
         print(f"   Se obtuvieron URLs temporales usando el SDK de Nuclia")
     except Exception as e:
         print(f"\n❌ Error: {e}")
-        import traceback
         traceback.print_exc()
 